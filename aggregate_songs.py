@@ -2,8 +2,11 @@
 """Aggregate songs by matching titles across different URLs/platforms."""
 
 import duckdb
+import heapq
 import re
+import unicodedata
 from collections import defaultdict
+from functools import lru_cache
 
 # Manual mappings for songs that are hard to match automatically
 # Maps a "canonical name" to patterns that identify it
@@ -21,85 +24,120 @@ SONG_PATTERNS = {
     "Pizzicato Five - Twiggy Twiggy": ["twiggy twiggy"],
     "La Bamba": ["la bamba"],
     "Los Fabulosos Cadillacs - Matador": ["fabulosos cadillacs", "cadillacs matador"],
-    "Sigur Rós - Hoppípolla": ["hoppipolla", "hoppípolla"],
-    "Bomba Estéreo - Soy Yo": ["bomba estereo soy yo", "bomba estéreo soy yo"],
+    "Sigur Rós - Hoppípolla": ["hoppipolla"],
+    "Bomba Estéreo - Soy Yo": ["bomba estereo soy yo"],
     "Daddy Yankee - Gasolina": ["gasolina"],
 }
 
+# Map each pattern back to its canonical name, and scan for all of them in a
+# single pass with one alternation regex
+_PATTERN_TO_SONG = {
+    pattern: canonical
+    for canonical, patterns in SONG_PATTERNS.items()
+    for pattern in patterns
+}
+_SONG_RE = re.compile('|'.join(map(re.escape, _PATTERN_TO_SONG)))
+
+
+# Precompiled normalization patterns, built once at import time.
+# _ACCENT_RE matches the combining accent marks that NFKD splits off Latin letters.
+_ACCENT_RE = re.compile('(?<=[a-z])[\u0300-\u036f]+')
+_PAREN_RE = re.compile(r'\s*[\(\[][^\)\]]*[\)\]]')
+_PUNCT_RE = re.compile(r'[^\w\s]+')
+_WS_RE = re.compile(r'\s+')
+
 
+@lru_cache(maxsize=None)
 def normalize_title(title):
     """Normalize a title for matching."""
     if not title:
         return ''
-    t = title.lower()
-    # Normalize unicode
-    t = t.replace('ç', 'c').replace('é', 'e').replace('ó', 'o').replace('í', 'i')
+    # Normalize unicode: decompose, drop accents from Latin letters, then
+    # recompose so marks in other scripts (kana, hangul, й) stay attached
+    t = _ACCENT_RE.sub('', unicodedata.normalize('NFKD', title.lower()))
+    t = unicodedata.normalize('NFC', t)
     # Remove everything in parens/brackets
-    t = re.sub(r'\s*[\(\[].*?[\)\]]', '', t)
+    t = _PAREN_RE.sub('', t)
     # Remove punctuation
-    t = re.sub(r'[^\w\s]', ' ', t)
-    t = re.sub(r'\s+', ' ', t).strip()
-    return t
+    t = _PUNCT_RE.sub(' ', t)
+    return _WS_RE.sub(' ', t).strip()
 
 
-def match_song(title):
-    """Try to match a title to a canonical song name."""
-    norm = normalize_title(title)
-    for canonical, patterns in SONG_PATTERNS.items():
-        for pattern in patterns:
-            if pattern in norm:
-                return canonical
-    return None
+def match_song(norm):
+    """Try to match a normalized title to a canonical song name."""
+    m = _SONG_RE.search(norm)
+    return _PATTERN_TO_SONG[m.group()] if m else None
+
+
+def summarize_songs(groups):
+    """Collapse (title, rowids, urls, count) rows grouped by song key, sorted by count.
+    
+    Each song's urls are merged back into post order using the rowids.
+    """
+    summaries = [
+        (key, {
+            "count": sum(count for _, _, _, count in song_rows),
+            "urls": [url for _, url in heapq.merge(
+                *(zip(rowids, urls) for _, rowids, urls, _ in song_rows)
+            )],
+            "titles": {title for title, _, _, _ in song_rows},
+        })
+        for key, song_rows in groups.items()
+    ]
+    return sorted(summaries, key=lambda x: -x[1]["count"])
 
 
 def aggregate_songs(db_path="bangers.duckdb"):
     """Aggregate songs and return sorted list."""
     con = duckdb.connect(db_path)
     
+    # Group identical titles in the database so we only match each one once,
+    # skipping GIFs, whose titles describe the image rather than a song.
+    # Ordering by first appearance keeps ties in a stable order.
     rows = con.execute('''
-        SELECT media_url, media_title
+        SELECT media_title, LIST(rowid ORDER BY rowid), LIST(media_url ORDER BY rowid), COUNT(*)
         FROM posts 
         WHERE media_url IS NOT NULL AND media_title IS NOT NULL
+        AND media_url NOT ILIKE '%tenor.com/%'
+        AND media_url NOT ILIKE '%giphy.com/%'
+        GROUP BY media_title
+        ORDER BY MIN(rowid)
     ''').fetchall()
     
-    # Count by canonical song name
-    song_counts = defaultdict(lambda: {"count": 0, "urls": [], "titles": set()})
-    unmatched = defaultdict(lambda: {"count": 0, "urls": [], "titles": set()})
+    # Assign each distinct title to a song, then build every song's entry
+    # in one go instead of updating nested dicts row by row
+    song_rows = defaultdict(list)
+    unmatched_rows = defaultdict(list)
     
-    for url, title in rows:
-        canonical = match_song(title)
+    for row in rows:
+        norm = normalize_title(row[0])
+        canonical = match_song(norm)
         if canonical:
-            song_counts[canonical]["count"] += 1
-            song_counts[canonical]["urls"].append(url)
-            song_counts[canonical]["titles"].add(title)
+            song_rows[canonical].append(row)
         else:
             # Use normalized title as key for unmatched
-            norm = normalize_title(title)
-            unmatched[norm]["count"] += 1
-            unmatched[norm]["urls"].append(url)
-            unmatched[norm]["titles"].add(title)
+            unmatched_rows[norm].append(row)
     
     # Sort matched songs
-    sorted_songs = sorted(song_counts.items(), key=lambda x: -x[1]["count"])
+    sorted_songs = summarize_songs(song_rows)
     
     # Add top unmatched songs
-    sorted_unmatched = sorted(unmatched.items(), key=lambda x: -x[1]["count"])
+    sorted_unmatched = summarize_songs(unmatched_rows)
     
     return sorted_songs, sorted_unmatched
 
 
 def get_best_youtube_url(urls):
     """Pick the best YouTube URL from a list."""
+    fallback = None
     for url in urls:
-        if 'youtube.com/watch' in url or 'youtu.be/' in url:
-            # Prefer youtube.com over youtu.be
-            if 'youtube.com' in url:
-                return url
-    # Fall back to first youtube URL
-    for url in urls:
-        if 'youtu' in url:
+        # Prefer youtube.com watch URLs over youtu.be and other YouTube links
+        if 'youtube.com/watch' in url:
             return url
-    return urls[0] if urls else None
+        # Otherwise fall back to the first youtube URL
+        if fallback is None and 'youtu' in url:
+            fallback = url
+    return fallback or (urls[0] if urls else None)
 
 
 if __name__ == "__main__":
@@ -6,15 +6,38 @@ import requests
 import json
 import re
 import os
-from urllib.parse import urlparse, parse_qs
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
 
 API_BASE = "https://public.api.bsky.app/xrpc"
 AUTH_API_BASE = "https://bsky.social/xrpc"
 
-# Global session with auth
+# Max concurrent API requests, shared by all threads
+MAX_WORKERS = 16
+
+# Bluesky allows 3000 requests per 5 minutes per IP, i.e. 10 per second
+REQUESTS_PER_SECOND = 10
+# How many times to retry a request that got HTTP 429 Too Many Requests
+MAX_RETRIES = 5
+
+# Global session with auth, pooling enough connections for every worker
 session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=2, pool_maxsize=MAX_WORKERS))
 access_token = None
 
+# True while a bulk crawl runs inside one transaction (see bulk_transaction)
+in_bulk_transaction = False
+
+# Matches bsky.app/profile/HANDLE/post/ID, capturing the handle and post ID
+_BSKY_RE = re.compile(r'bsky\.app/profile/([^/]+)/post/([^/?#]+)')
+
+# Matches youtube.com/watch?...v=ID and youtu.be/ID, capturing the 11-char ID
+_YT_RE = re.compile(r'(?:youtube\.com/watch\?(?:[^#\s]*&)?v=|youtu\.be/)([A-Za-z0-9_-]{11})')
+
 def login():
     """Authenticate with Bluesky using app password."""
     global access_token
@@ -42,10 +65,53 @@ def login():
         print(f"Auth failed: {resp.status_code} - {resp.text}")
         return False
 
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` calls per second, bursting to `capacity`."""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Take a token, sleeping until one is available."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going negative reserves a future token, so waiters queue up in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+rate_limiter = TokenBucket(REQUESTS_PER_SECOND, MAX_WORKERS)
+
+def retry_delay(resp, attempt):
+    """Seconds to wait before retrying a rate-limited response."""
+    # Honor Retry-After if given, else Bluesky's RateLimit-Reset epoch time
+    retry_after = resp.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        return int(retry_after)
+    reset = resp.headers.get('RateLimit-Reset', '')
+    if reset.isdigit():
+        return max(int(reset) - time.time(), 1)
+    # Otherwise back off exponentially
+    return 2 ** attempt
+
 def api_get(endpoint, params=None):
-    """Make an authenticated GET request."""
+    """Make an authenticated GET request, retrying if rate limited."""
     url = f"{API_BASE}/{endpoint}"
-    resp = session.get(url, params=params)
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        resp = session.get(url, params=params)
+        if resp.status_code != 429 or attempt == MAX_RETRIES:
+            break
+        delay = retry_delay(resp, attempt)
+        print(f"Rate limited on {endpoint}, retrying in {delay:.0f}s...")
+        time.sleep(delay)
     resp.raise_for_status()
     return resp.json()
 
@@ -81,16 +147,45 @@ def init_db(db_path="bangers.duckdb"):
     con.commit()
     return con
 
+def commit(con):
+    """Commit the current work, unless a bulk transaction will commit it later."""
+    if not in_bulk_transaction:
+        con.commit()
+
+@contextmanager
+def bulk_transaction(con):
+    """Run a bulk crawl inside a single transaction with one commit at the end.
+    
+    On ^C or a Python-level error, commits whatever was crawled so far and
+    re-raises. A failed DuckDB statement aborts the whole transaction, so in
+    that case nothing from the crawl is saved: it is rolled back and the
+    original error re-raised.
+    """
+    global in_bulk_transaction
+    
+    con.execute("BEGIN TRANSACTION")
+    in_bulk_transaction = True
+    try:
+        yield
+    except BaseException:
+        try:
+            # Any statement fails once the transaction has been aborted
+            con.execute("SELECT 1")
+        except duckdb.Error:
+            con.execute("ROLLBACK")
+            print("A database error aborted the transaction; nothing from this crawl was saved")
+        else:
+            con.execute("COMMIT")
+        raise
+    else:
+        con.execute("COMMIT")
+    finally:
+        in_bulk_transaction = False
+
 def extract_youtube_id(url):
     """Extract YouTube video ID from various URL formats."""
-    if not url:
-        return None
-    parsed = urlparse(url)
-    if 'youtube.com' in parsed.netloc:
-        return parse_qs(parsed.query).get('v', [None])[0]
-    elif 'youtu.be' in parsed.netloc:
-        return parsed.path.lstrip('/')
-    return None
+    m = _YT_RE.search(url) if url else None
+    return m.group(1) if m else None
 
 def extract_media_info(record, embed_view=None):
     """Extract media URL and info from post embed."""
@@ -128,6 +223,11 @@ def extract_quoted_uri(record):
         return embed.get('record', {}).get('record', {}).get('uri')
     return None
 
+@lru_cache(maxsize=8192)
+def resolve_handle(handle):
+    """Resolve a handle to its DID, caching results for the life of the process."""
+    return api_get('com.atproto.identity.resolveHandle', {'handle': handle}).get('did')
+
 def resolve_uri_to_did(uri):
     """Convert a handle-based URI to a DID-based URI."""
     # at://handle/collection/rkey -> at://did/collection/rkey
@@ -140,8 +240,7 @@ def resolve_uri_to_did(uri):
     
     # Resolve handle to DID
     try:
-        data = api_get('com.atproto.identity.resolveHandle', {'handle': handle})
-        did = data.get('did')
+        did = resolve_handle(handle)
         if did:
             return f"at://{did}/{rest}"
     except:
@@ -157,87 +256,124 @@ def fetch_post(uri):
     })
     return data.get('thread', {}).get('post')
 
-def save_post(con, post, force_update=False):
-    """Save a post to the database.
+def fetch_posts(uris, max_workers=MAX_WORKERS):
+    """Fetch many posts concurrently.
     
-    If post exists and quote_count increased, marks quotes_crawled=FALSE so we re-crawl.
-    Returns True if this is a new post, False if it already existed.
+    Yields (uri, post, error) tuples in the same order as uris.
     """
-    if not post:
-        return False
-    
-    uri = post.get('uri')
+    def fetch(uri):
+        try:
+            return uri, fetch_post(uri), None
+        except Exception as e:
+            return uri, None, e
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        yield from ex.map(fetch, uris)
+
+def build_row(post):
+    """Build the posts table row for an API post, in INSERT column order."""
     record = post.get('record', {})
     author = post.get('author', {})
     
     embed_type, media_url, media_title, media_desc = extract_media_info(record)
     quotes_uri = extract_quoted_uri(record)
-    new_quote_count = post.get('quoteCount', 0)
     
-    # Check if post exists and if quote count changed
-    existing = con.execute(
-        "SELECT quote_count, quotes_crawled FROM posts WHERE uri = ?", [uri]
-    ).fetchone()
+    return (
+        post.get('uri'),
+        post.get('cid'),
+        author.get('did'),
+        author.get('handle'),
+        author.get('displayName'),
+        record.get('text'),
+        record.get('createdAt'),
+        post.get('indexedAt'),
+        post.get('likeCount', 0),
+        post.get('quoteCount', 0),
+        post.get('repostCount', 0),
+        post.get('replyCount', 0),
+        quotes_uri,
+        embed_type,
+        media_url,
+        media_title,
+        media_desc
+    )
+
+def upsert_rows(con, rows, force_update=False):
+    """Insert or update rows from build_row with one statement."""
+    # Send the whole batch as one multi-row VALUES list, so DuckDB parses and
+    # plans a single statement per page instead of one per post. Timestamps
+    # that don't parse are stored as NULL rather than failing the statement.
+    values = ',\n'.join(
+        ['(?, ?, ?, ?, ?, ?, TRY_CAST(? AS TIMESTAMP), TRY_CAST(? AS TIMESTAMP), '
+         '?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, FALSE)'] * len(rows)
+    )
+    params = [value for row in rows for value in row]
+    
+    con.execute(f"""
+        INSERT INTO posts (
+            uri, cid, author_did, author_handle, author_display_name,
+            text, created_at, indexed_at,
+            like_count, quote_count, repost_count, reply_count,
+            quotes_uri, embed_type, media_url, media_title, media_description,
+            crawled_at, quotes_crawled
+        ) VALUES {values}
+        ON CONFLICT (uri) DO UPDATE SET
+            like_count = excluded.like_count,
+            quote_count = excluded.quote_count,
+            repost_count = excluded.repost_count,
+            reply_count = excluded.reply_count,
+            -- If quote count increased, we need to re-crawl
+            quotes_crawled = CASE
+                WHEN excluded.quote_count > COALESCE(posts.quote_count, 0) THEN FALSE
+                ELSE posts.quotes_crawled
+            END
+        WHERE {'TRUE' if force_update else 'excluded.quote_count > COALESCE(posts.quote_count, 0)'}
+    """, params)
+
+def aborts_transaction(error):
+    """Whether a failed save has aborted the current bulk transaction.
+    
+    A statement DuckDB runs and fails aborts the transaction, so nothing more
+    can be saved in it; bulk_transaction should report the real error. Errors
+    raised while binding parameters (e.g. unencodable text) leave it usable.
+    """
+    return in_bulk_transaction and isinstance(error, duckdb.Error)
+
+def save_posts(con, posts, force_update=False):
+    """Save a batch of posts to the database with a single commit.
+    
+    New posts are inserted. Existing posts get their counts refreshed if
+    quote_count increased (or always, with force_update), and are marked
+    quotes_crawled=FALSE when quote_count increased so we re-crawl.
+    """
+    # Dedupe by URI, since one statement can't upsert the same post twice
+    rows = {}
+    for post in posts:
+        if post and post.get('uri'):
+            row = build_row(post)
+            rows[row[0]] = row
+    if not rows:
+        return
     
-    if existing:
-        old_quote_count, was_crawled = existing
-        # If quote count increased, we need to re-crawl
-        needs_recrawl = new_quote_count > (old_quote_count or 0)
-        
-        if force_update or needs_recrawl:
-            con.execute("""
-                UPDATE posts SET
-                    like_count = ?,
-                    quote_count = ?,
-                    repost_count = ?,
-                    reply_count = ?,
-                    quotes_crawled = ?
-                WHERE uri = ?
-            """, [
-                post.get('likeCount', 0),
-                new_quote_count,
-                post.get('repostCount', 0),
-                post.get('replyCount', 0),
-                False if needs_recrawl else was_crawled,
-                uri
-            ])
-            con.commit()
-        return False  # Not a new post
-    
-    # New post - insert it
     try:
-        con.execute("""
-            INSERT INTO posts (
-                uri, cid, author_did, author_handle, author_display_name,
-                text, created_at, indexed_at,
-                like_count, quote_count, repost_count, reply_count,
-                quotes_uri, embed_type, media_url, media_title, media_description,
-                crawled_at, quotes_crawled
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, FALSE)
-        """, [
-            uri,
-            post.get('cid'),
-            author.get('did'),
-            author.get('handle'),
-            author.get('displayName'),
-            record.get('text'),
-            record.get('createdAt'),
-            post.get('indexedAt'),
-            post.get('likeCount', 0),
-            new_quote_count,
-            post.get('repostCount', 0),
-            post.get('replyCount', 0),
-            quotes_uri,
-            embed_type,
-            media_url,
-            media_title,
-            media_desc
-        ])
-        con.commit()
-        return True  # New post
+        upsert_rows(con, list(rows.values()), force_update)
     except Exception as e:
-        print(f"Error saving post: {e}")
-        return False
+        if aborts_transaction(e):
+            raise
+        # Retry one post at a time so a single bad post doesn't drop the page
+        print(f"Error saving posts, retrying one at a time: {e}")
+        for row in rows.values():
+            try:
+                upsert_rows(con, [row], force_update)
+            except Exception as e:
+                if aborts_transaction(e):
+                    raise
+                print(f"Error saving post {row[0]}: {e}")
+    commit(con)
+
+def save_post(con, post, force_update=False):
+    """Save a single post to the database."""
+    save_posts(con, [post], force_update)
 
 def fetch_quotes(uri, cursor=None):
     """Fetch posts that quote a given URI."""
@@ -282,58 +418,103 @@ def crawl_to_root(con, start_uri):
     
     return chain
 
-def crawl_quotes_bfs(con, root_uri, max_depth=None):
-    """Crawl all quotes starting from root using BFS."""
-    from collections import deque
+def crawl_quotes_bfs(con, root_uri, max_depth=None, seen=None):
+    """Crawl all quotes starting from root using BFS, one depth level at a time.
     
-    queue = deque([(root_uri, 0)])
+    If given, seen is updated with every URI queued, so callers can share it
+    across crawls to skip posts an earlier crawl already reached.
+    """
+    if seen is None:
+        seen = set()
+    seen.add(root_uri)
+    level = [root_uri]
+    depth = 0
     total_crawled = 0
     
-    while queue:
-        uri, depth = queue.popleft()
-        
-        if max_depth is not None and depth > max_depth:
-            continue
-        
-        # Check if we've already crawled quotes for this post
-        result = con.execute(
-            "SELECT quotes_crawled, quote_count FROM posts WHERE uri = ?", [uri]
-        ).fetchone()
+    while level and (max_depth is None or depth <= max_depth):
+        # Check which posts in this level we've already crawled quotes for
+        placeholders = ', '.join('?' * len(level))
+        status = {
+            uri: (quotes_crawled, quote_count)
+            for uri, quotes_crawled, quote_count in con.execute(
+                f"SELECT uri, quotes_crawled, quote_count FROM posts WHERE uri IN ({placeholders})",
+                level
+            ).fetchall()
+        }
+        next_level = []
         
-        if not result:
-            # We don't have this post yet, fetch it
-            post = fetch_post(uri)
-            if post:
-                save_post(con, post)
-                result = (False, post.get('quoteCount', 0))
-        
-        if result and not result[0]:  # Not yet crawled quotes
-            quote_count = result[1] or 0
-            if quote_count > 0:
-                print(f"Fetching {quote_count} quotes for {uri[:50]}... (depth={depth})")
-                
-                cursor = None
-                while True:
-                    data = fetch_quotes(uri, cursor)
-                    posts = data.get('posts', [])
-                    
-                    for post in posts:
-                        save_post(con, post)
-                        total_crawled += 1
-                        post_uri = post.get('uri')
-                        if post.get('quoteCount', 0) > 0:
-                            queue.append((post_uri, depth + 1))
-                    
-                    cursor = data.get('cursor')
-                    if not cursor or not posts:
-                        break
+        for uri in level:
+            result = status.get(uri)
+            
+            if not result:
+                # We don't have this post yet, fetch it
+                post = fetch_post(uri)
+                if post:
+                    save_post(con, post)
+                    result = (False, post.get('quoteCount', 0))
             
-            # Mark as crawled
-            con.execute("UPDATE posts SET quotes_crawled = TRUE WHERE uri = ?", [uri])
-            con.commit()
+            if result and not result[0]:  # Not yet crawled quotes
+                quote_count = result[1] or 0
+                if quote_count > 0:
+                    print(f"Fetching {quote_count} quotes for {uri[:50]}... (depth={depth})")
+                    
+                    # Fetch the next page in the background while saving this one
+                    with ThreadPoolExecutor(max_workers=1) as ex:
+                        data = fetch_quotes(uri)
+                        while True:
+                            posts = data.get('posts', [])
+                            cursor = data.get('cursor')
+                            next_page = ex.submit(fetch_quotes, uri, cursor) if cursor and posts else None
+                            
+                            save_posts(con, posts)
+                            total_crawled += len(posts)
+                            for post in posts:
+                                post_uri = post.get('uri')
+                                if post.get('quoteCount', 0) > 0 and post_uri not in seen:
+                                    seen.add(post_uri)
+                                    next_level.append(post_uri)
+                            
+                            if not next_page:
+                                break
+                            data = next_page.result()
+                
+                # Mark as crawled
+                con.execute("UPDATE posts SET quotes_crawled = TRUE WHERE uri = ?", [uri])
+                commit(con)
+        
+        level = next_level
+        depth += 1
     
     return total_crawled
 
+def crawl_all(con):
+    """Crawl quotes for every post that has uncrawled quotes, most quoted first.
+    
+    Returns once no post with uncrawled quotes is left.
+    """
+    while True:
+        # Fetch the whole worklist at once instead of re-querying for each post.
+        # A post crawled early in a pass can be reset to uncrawled when its
+        # parent's quotes show a higher quote_count, so repeat until a pass
+        # finds nothing left.
+        worklist = con.execute('''
+            SELECT uri, quote_count FROM posts 
+            WHERE quote_count > 0 AND quotes_crawled = FALSE
+            ORDER BY quote_count DESC
+        ''').fetchall()
+        
+        if not worklist:
+            break
+        
+        # Skip worklist entries an earlier BFS in this pass already reached
+        seen = set()
+        for uri, qcount in worklist:
+            if uri in seen:
+                continue
+            print(f"\nCrawling {qcount} quotes from {uri[:60]}...")
+            count = crawl_quotes_bfs(con, uri, seen=seen)
+            print(f"Got {count} new posts")
+
 
 def print_stats(con):
     """Print database statistics."""
@@ -388,8 +569,11 @@ if __name__ == "__main__":
         # Convert bsky.app URL to AT URI
         url = sys.argv[2]
         # https://bsky.app/profile/handle/post/id -> at://handle/app.bsky.feed.post/id
-        parts = url.replace("https://bsky.app/profile/", "").split("/post/")
-        handle, post_id = parts[0], parts[1]
+        m = _BSKY_RE.search(url)
+        if not m:
+            print(f"Not a bsky.app post URL: {url}")
+            sys.exit(1)
+        handle, post_id = m.group(1), m.group(2)
         uri = f"at://{handle}/app.bsky.feed.post/{post_id}"
         
         print(f"Tracing from: {uri}")
@@ -401,7 +585,8 @@ if __name__ == "__main__":
     elif cmd == "crawl":
         uri = sys.argv[2]
         print(f"Crawling quotes from: {uri}")
-        count = crawl_quotes_bfs(con, uri)
+        with bulk_transaction(con):
+            count = crawl_quotes_bfs(con, uri)
         print(f"\nCrawled {count} new posts")
         print_stats(con)
         
@@ -409,23 +594,10 @@ if __name__ == "__main__":
         print_stats(con)
     
     elif cmd == "crawl-all":
-        # Crawl all posts that have uncrawled quotes
-        while True:
-            row = con.execute('''
-                SELECT uri, quote_count FROM posts 
-                WHERE quote_count > 0 AND quotes_crawled = FALSE
-                ORDER BY quote_count DESC
-                LIMIT 1
-            ''').fetchone()
-            
-            if not row:
-                print("All quotes crawled!")
-                break
-            
-            uri, qcount = row
-            print(f"\nCrawling {qcount} quotes from {uri[:60]}...")
-            count = crawl_quotes_bfs(con, uri)
-            print(f"Got {count} new posts")
+        # Crawl all posts that have uncrawled quotes, committing once at the end
+        with bulk_transaction(con):
+            crawl_all(con)
+        print("All quotes crawled!")
         
         print_stats(con)
     
@@ -438,47 +610,33 @@ if __name__ == "__main__":
         
         # Get all posts that had quotes (most likely to have new ones)
         posts_with_quotes = con.execute('''
-            SELECT uri FROM posts 
+            SELECT uri, quote_count FROM posts 
             WHERE quote_count > 0
             ORDER BY quote_count DESC
         ''').fetchall()
+        old_counts = dict(posts_with_quotes)
         
+        # Fetch in parallel, but keep all database writes on this thread
         updated = 0
-        for (uri,) in posts_with_quotes:
-            try:
-                post = fetch_post(uri)
-                if post:
-                    old_count = con.execute(
-                        "SELECT quote_count FROM posts WHERE uri = ?", [uri]
-                    ).fetchone()[0] or 0
-                    new_count = post.get('quoteCount', 0)
-                    
-                    if new_count > old_count:
-                        print(f"  {uri[:50]}... {old_count} -> {new_count} quotes")
-                        save_post(con, post, force_update=True)
-                        updated += 1
-            except Exception as e:
-                print(f"  Error fetching {uri[:50]}: {e}")
+        for uri, post, error in fetch_posts(old_counts):
+            if error:
+                print(f"  Error fetching {uri[:50]}: {error}")
+                continue
+            if post:
+                old_count = old_counts[uri] or 0
+                new_count = post.get('quoteCount', 0)
+                
+                if new_count > old_count:
+                    print(f"  {uri[:50]}... {old_count} -> {new_count} quotes")
+                    save_post(con, post, force_update=True)
+                    updated += 1
         
         print(f"\nFound {updated} posts with new quotes")
         
         if updated > 0:
             print("\nCrawling new quotes...")
             # Now crawl-all to get the new quotes
-            while True:
-                row = con.execute('''
-                    SELECT uri, quote_count FROM posts 
-                    WHERE quote_count > 0 AND quotes_crawled = FALSE
-                    ORDER BY quote_count DESC
-                    LIMIT 1
-                ''').fetchone()
-                
-                if not row:
-                    break
-                
-                uri, qcount = row
-                print(f"Crawling {qcount} quotes from {uri[:50]}...")
-                crawl_quotes_bfs(con, uri)
+            crawl_all(con)
         
         print_stats(con)
     
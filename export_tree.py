@@ -2,18 +2,16 @@
 """Export the banger tree to various formats."""
 
 import duckdb
-import json
-from urllib.parse import urlparse, parse_qs
+import orjson
+import re
+from collections import defaultdict
+
+# Matches youtube.com/watch?...v=ID and youtu.be/ID, capturing the 11-char ID
+_YT_RE = re.compile(r'(?:youtube\.com/watch\?(?:[^#\s]*&)?v=|youtu\.be/)([A-Za-z0-9_-]{11})')
 
 def extract_video_id(url):
-    if not url:
-        return None
-    parsed = urlparse(url)
-    if 'youtube.com' in parsed.netloc or 'www.youtube.com' in parsed.netloc:
-        return parse_qs(parsed.query).get('v', [None])[0]
-    elif 'youtu.be' in parsed.netloc:
-        return parsed.path.lstrip('/').split('?')[0]
-    return None
+    m = _YT_RE.search(url) if url else None
+    return m.group(1) if m else None
 
 def export_to_json(con, output_file='banger_tree.json'):
     """Export tree structure to JSON."""
@@ -26,46 +24,33 @@ def export_to_json(con, output_file='banger_tree.json'):
         FROM posts
     ''').fetchall()
     
-    # Build lookup
-    post_map = {}
+    # Build the tree in one pass. Each node's children list is shared with
+    # children_of, so children seen later in the rows are attached as well.
+    # Nodes whose parent isn't in the database never reach a root.
+    children_of = defaultdict(list)
+    roots = []
     for p in posts:
         uri, handle, display, text, parent, media_url, media_title, likes, quotes, created = p
-        post_map[uri] = {
+        node = {
             'uri': uri,
             'author': display or handle,
             'handle': handle,
             'text': text[:100] if text else '',
-            'parent': parent,
             'media_url': media_url,
             'media_title': media_title,
             'youtube_id': extract_video_id(media_url),
             'likes': likes,
             'quotes': quotes,
             'created': str(created) if created else None,
-            'children': []
+            'children': children_of[uri]
         }
-    
-    # Build tree structure
-    roots = []
-    for uri, node in post_map.items():
-        parent_uri = node['parent']
-        if parent_uri and parent_uri in post_map:
-            post_map[parent_uri]['children'].append(node)
-        elif not parent_uri:
+        if parent:
+            children_of[parent].append(node)
+        else:
             roots.append(node)
     
-    # Remove parent references for cleaner JSON
-    def clean_node(node):
-        del node['parent']
-        for child in node['children']:
-            clean_node(child)
-        return node
-    
-    for root in roots:
-        clean_node(root)
-    
-    with open(output_file, 'w') as f:
-        json.dump(roots, f, indent=2)
+    with open(output_file, 'wb') as f:
+        f.write(orjson.dumps(roots, option=orjson.OPT_INDENT_2))
     
     print(f"Exported tree to {output_file}")
     return roots
@@ -74,36 +59,36 @@ def export_to_json(con, output_file='banger_tree.json'):
 def export_song_stats(con, output_file='song_stats.json'):
     """Export song statistics."""
     
+    # Aggregate by video ID in the database, keeping first-seen title and
+    # poster order, and sort by count (ties in first-seen order)
     rows = con.execute('''
-        SELECT media_url, media_title, author_handle, like_count
+        SELECT regexp_extract(media_url, ?, 1) AS vid,
+               arg_min(media_title, rowid) AS title,
+               COUNT(*) AS cnt,
+               SUM(COALESCE(like_count, 0)) AS total_likes,
+               LIST(author_handle ORDER BY rowid) AS posters
         FROM posts 
         WHERE media_url IS NOT NULL 
         AND (media_url LIKE '%youtu%' OR media_url LIKE '%youtube%')
-    ''').fetchall()
-    
-    # Aggregate by video ID
-    videos = {}
-    for url, title, author, likes in rows:
-        vid = extract_video_id(url)
-        if vid:
-            if vid not in videos:
-                videos[vid] = {
-                    'id': vid,
-                    'title': title,
-                    'url': f'https://youtube.com/watch?v={vid}',
-                    'count': 0,
-                    'total_likes': 0,
-                    'posters': []
-                }
-            videos[vid]['count'] += 1
-            videos[vid]['total_likes'] += likes or 0
-            videos[vid]['posters'].append(author)
-    
-    # Sort by count
-    sorted_videos = sorted(videos.values(), key=lambda x: -x['count'])
+        GROUP BY vid
+        HAVING vid <> ''
+        ORDER BY cnt DESC, MIN(rowid)
+    ''', [_YT_RE.pattern]).fetchall()
+    
+    sorted_videos = [
+        {
+            'id': vid,
+            'title': title,
+            'url': f'https://youtube.com/watch?v={vid}',
+            'count': count,
+            'total_likes': total_likes,
+            'posters': posters
+        }
+        for vid, title, count, total_likes, posters in rows
+    ]
     
-    with open(output_file, 'w') as f:
-        json.dump(sorted_videos[:100], f, indent=2)  # Top 100
+    with open(output_file, 'wb') as f:
+        f.write(orjson.dumps(sorted_videos[:100], option=orjson.OPT_INDENT_2))  # Top 100
     
     print(f"Exported song stats to {output_file}")
     return sorted_videos